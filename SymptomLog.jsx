@@ -102,6 +102,10 @@ const SymptomLog = (props) => {
         }).then((res) => res.json())
             .then(
                 (result) => {
+                    // throttled keystrokes keep the current symptoms
+                    if (result.throttled) {
+                        return;
+                    }
                     if (result.symptoms_json.mentions === undefined) {
                         updateSelected(0 - illness.length,
                             result.symptoms_json.mentions, illness);
@@ -0,0 +1,207 @@
+# python library imports
+import json
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+# Database imports
+from app.main.model.illness import Illness, Symptom, Diagnosis
+from app.main.model.user import User
+from app.main import db
+# Utility imports
+import requests
+from app.main.service.illness_service import (
+    calculate_age,
+    request_diagnosis_conditions
+)
+from app.main.util.throttle import TokenBucket
+
+CURR_PATH = os.path.dirname(os.path.realpath(__file__))
+REDIAGNOSIS_CHECKPOINT_PATH = os.path.join(
+    CURR_PATH,
+    'resources/diagnosis_service/rediagnosis_checkpoint.json'
+)
+# resume continues an unfinished run or starts a new one, restart ignores
+# the checkpoint, retry_failed re-runs only the failures of the last run
+REDIAGNOSIS_MODES = ('resume', 'restart', 'retry_failed')
+
+
+def new_checkpoint():
+    return {'last_illness_id': 0, 'failed_illness_ids': [], 'completed': False}
+
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.isfile(checkpoint_path):
+        return new_checkpoint()
+    with open(checkpoint_path, 'r') as checkpoint_f:
+        return json.load(checkpoint_f)
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+    # write to a temporary file first so a crash never leaves it truncated
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_f:
+        json.dump(checkpoint, checkpoint_f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def diagnosed_since(illness_ids, after_diagnosis_id):
+    """
+    Finds the illnesses that got a diagnosis newer than the given one,
+    diagnosis ids only ever grow
+    :return: set of illness ids
+    """
+    rows = db.session.query(Diagnosis.illness_id).filter(
+        Diagnosis.illness_id.in_(illness_ids),
+        Diagnosis.id > after_diagnosis_id
+    ).distinct()
+    return {illness_id for illness_id, in rows}
+
+
+def fetch_active_illness_batch(after_id, batch_size, only_ids=None):
+    """
+    Loads the next batch of active illnesses along with their users and
+    symptom evidence using two queries for the whole batch
+    :return: list of dicts
+    """
+    illness_query = db.session.query(Illness, User).join(
+        User,
+        User.id == Illness.user_id
+    ).filter(
+        Illness.active.is_(True),
+        Illness.id > after_id
+    )
+    if only_ids is not None:
+        illness_query = illness_query.filter(Illness.id.in_(only_ids))
+    rows = illness_query.order_by(Illness.id).limit(batch_size).all()
+    illness_ids = [illness.id for illness, _ in rows]
+    evidence = defaultdict(list)
+    if illness_ids:
+        symptoms_query = db.session.query(
+            Symptom.illness_id,
+            Symptom.data
+        ).filter(
+            Symptom.illness_id.in_(illness_ids)
+        ).order_by(Symptom.illness_id, -Symptom.id)
+        for illness_id, data in symptoms_query:
+            evidence[illness_id].append({
+                'id': data['id'],
+                'choice_id': 'present'
+            })
+    return [{
+        'illness_id': illness.id,
+        'user_id': user.id,
+        'sex': user.sex.lower() if user.sex != "None" else 'male',
+        'age': calculate_age(user.birthdate),
+        'evidence': evidence[illness.id]
+    } for illness, user in rows]
+
+
+def rediagnose_active_illnesses(checkpoint_path=REDIAGNOSIS_CHECKPOINT_PATH,
+                                mode='resume', batch_size=200, max_workers=8,
+                                requests_per_second=10):
+    """
+    Re-runs the diagnosis for every active illness. Upstream calls are made
+    from a fixed pool of workers sharing one rate limiter, and the resulting
+    diagnoses are written once per batch. Progress is saved to the
+    checkpoint file after every batch, see REDIAGNOSIS_MODES for how it is
+    used on the next run.
+    :return: dict
+    """
+    if mode not in REDIAGNOSIS_MODES:
+        raise ValueError('mode must be one of {}'.format(REDIAGNOSIS_MODES))
+    checkpoint = load_checkpoint(checkpoint_path)
+    if mode == 'restart' or (mode == 'resume' and checkpoint.get('completed')):
+        checkpoint = new_checkpoint()
+    if checkpoint.get('started_after_diagnosis_id') is None:
+        # diagnoses with a higher id were written during this run
+        checkpoint['started_after_diagnosis_id'] = db.session.query(
+            db.func.max(Diagnosis.id)
+        ).scalar() or 0
+        save_checkpoint(checkpoint_path, checkpoint)
+    rate_limiter = TokenBucket(requests_per_second)
+    local = threading.local()
+    summary = {'diagnosed': 0, 'skipped': 0, 'failed': 0}
+
+    def diagnose(item):
+        # requests sessions are not thread-safe, keep one per worker
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return request_diagnosis_conditions(
+            item['sex'],
+            item['age'],
+            item['evidence'],
+            http=local.session,
+            rate_limiter=rate_limiter
+        )
+
+    # diagnoses one batch and writes the results, returns the failed ids
+    def run_batch(executor, batch):
+        # a crash between committing a batch and saving the checkpoint
+        # leaves diagnoses newer than the run start, don't redo those
+        done_ids = diagnosed_since(
+            [item['illness_id'] for item in batch],
+            checkpoint['started_after_diagnosis_id']
+        ) if batch else set()
+        # illnesses without symptoms can't be diagnosed
+        to_diagnose = [
+            item for item in batch
+            if item['evidence'] and item['illness_id'] not in done_ids
+        ]
+        summary['skipped'] += len(batch) - len(to_diagnose)
+        futures = [
+            (item, executor.submit(diagnose, item))
+            for item in to_diagnose
+        ]
+        diagnoses = []
+        failed_ids = []
+        for item, future in futures:
+            try:
+                conditions = future.result()
+            except Exception as e:
+                print(e)
+                failed_ids.append(item['illness_id'])
+                continue
+            diagnoses.append(Diagnosis(
+                user_id=item['user_id'],
+                illness_id=item['illness_id'],
+                data=conditions
+            ))
+        db.session.add_all(diagnoses)
+        db.session.commit()
+        # release the loaded rows before fetching the next batch
+        db.session.expunge_all()
+        summary['diagnosed'] += len(diagnoses)
+        summary['failed'] += len(failed_ids)
+        return failed_ids
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if mode == 'retry_failed':
+            pending = sorted(checkpoint['failed_illness_ids'])
+            failed_again = []
+            while pending:
+                chunk, pending = pending[:batch_size], pending[batch_size:]
+                # closed or deleted illnesses are dropped from the retry list
+                batch = fetch_active_illness_batch(0, batch_size, chunk)
+                failed_again += run_batch(executor, batch)
+                checkpoint['failed_illness_ids'] = pending + failed_again
+                save_checkpoint(checkpoint_path, checkpoint)
+        else:
+            while True:
+                batch = fetch_active_illness_batch(
+                    checkpoint['last_illness_id'],
+                    batch_size
+                )
+                if not batch:
+                    break
+                checkpoint['failed_illness_ids'] += run_batch(executor, batch)
+                checkpoint['last_illness_id'] = batch[-1]['illness_id']
+                save_checkpoint(checkpoint_path, checkpoint)
+                print('Re-diagnosed illnesses up to id {}'.format(
+                    checkpoint['last_illness_id']
+                ))
+            # the next resume starts a fresh run, failures stay retryable
+            checkpoint['completed'] = True
+            save_checkpoint(checkpoint_path, checkpoint)
+    return summary
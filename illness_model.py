@@ -1,8 +1,14 @@
+import datetime
+import json
+import zlib
+
 from .. import db
 
 
 class Illness(db.Model):
     __tablename__ = 'illness'
+    # ids of archived rows must never be handed out again
+    __table_args__ = {'sqlite_autoincrement': True}
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -39,6 +45,7 @@ class Illness(db.Model):
 
 class Symptom(db.Model):
     __tablename__ = 'symptom'
+    __table_args__ = {'sqlite_autoincrement': True}
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(200), nullable=False)
@@ -80,6 +87,7 @@ class Symptom(db.Model):
 
 class Diagnosis(db.Model):
     __tablename__ = 'diagnosis'
+    __table_args__ = {'sqlite_autoincrement': True}
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
@@ -101,3 +109,92 @@ class Diagnosis(db.Model):
             'datetime': self.datetime.strftime("%Y-%m-%dT%H:%M:%SZ"),
             'diagnosis_json': self.data
         }
+
+
+class IllnessArchive(db.Model):
+    """ Closed illness moved out of the live tables, see archive_illness """
+    __tablename__ = 'illness_archive'
+
+    # same id the illness had in the live table
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('user.id'),
+        nullable=False,
+        index=True
+    )
+
+    title = db.Column(db.String(200), nullable=False)
+    created_on = db.Column(db.DateTime)
+    updated_on = db.Column(db.DateTime)
+    archived_on = db.Column(db.DateTime, server_default=db.func.now())
+
+    # zlib compressed JSON of the illness' symptom and diagnosis rows
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    @staticmethod
+    def from_illness(illness):
+        def timestamp(value):
+            return value.isoformat() if value else None
+        rows = {
+            'symptoms': [{
+                'id': s.id,
+                'user_id': s.user_id,
+                'title': s.title,
+                'data': s.data,
+                'created_on': timestamp(s.created_on),
+                'updated_on': timestamp(s.updated_on)
+            } for s in illness.symptoms],
+            'diagnoses': [{
+                'id': d.id,
+                'user_id': d.user_id,
+                'datetime': timestamp(d.datetime),
+                'data': d.data
+            } for d in illness.diagnoses]
+        }
+        return IllnessArchive(
+            id=illness.id,
+            user_id=illness.user_id,
+            title=illness.title,
+            created_on=illness.created_on,
+            updated_on=illness.updated_on,
+            data=zlib.compress(json.dumps(rows).encode('utf-8'))
+        )
+
+    def restore(self):
+        """
+        Rebuilds the archived illness with its symptoms and diagnoses,
+        the returned objects are not added to the session
+        :return: Illness
+        """
+        def timestamp(value):
+            return datetime.datetime.fromisoformat(value) if value else None
+        rows = json.loads(zlib.decompress(self.data).decode('utf-8'))
+        illness = Illness(
+            id=self.id,
+            user_id=self.user_id,
+            title=self.title,
+            active=False,
+            created_on=self.created_on,
+            updated_on=self.updated_on
+        )
+        illness.symptoms = [Symptom(
+            id=s['id'],
+            user_id=s['user_id'],
+            illness_id=self.id,
+            title=s['title'],
+            data=s['data'],
+            created_on=timestamp(s['created_on']),
+            updated_on=timestamp(s['updated_on'])
+        ) for s in rows['symptoms']]
+        illness.diagnoses = [Diagnosis(
+            id=d['id'],
+            user_id=d['user_id'],
+            illness_id=self.id,
+            datetime=timestamp(d['datetime']),
+            data=d['data']
+        ) for d in rows['diagnoses']]
+        return illness
+
+    def get_json(self):
+        return self.restore().get_json()
@@ -3,19 +3,39 @@ import requests
 import os
 import datetime
 import json
+import gzip
+import hashlib
+import threading
+import time
+import atexit
+from collections import OrderedDict
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
 # Database imports
-from app.main.model.illness import Illness, Symptom, Diagnosis
+from app.main.model.illness import (
+    Illness,
+    Symptom,
+    Diagnosis,
+    IllnessArchive
+)
 from app.main.model.user import User
 from app.main import db
 # Utility imports
 from flask_weasyprint import HTML, render_pdf
-from flask import render_template
+from flask import render_template, request, Response
+from sqlalchemy import case, event
+from sqlalchemy.orm import selectinload
+from app.main.util.throttle import TokenBucket
 
 
 def get_illness(id, user_id):
     response_object = {}
     try:
         illness = Illness.query.filter_by(id=id).first()
+        if not illness:
+            illness = IllnessArchive.query.filter_by(id=id).first()
     except Exception as e:
         print(e)
         return {
@@ -39,6 +59,12 @@ def get_illness(id, user_id):
 def edit_illness(user_id, illness_id, new_title, start_date=None,
                  end_date=None):
     illness = Illness.query.filter_by(user_id=user_id, id=illness_id).first()
+    if not illness:
+        # archived illnesses keep title and dates in their own columns
+        illness = IllnessArchive.query.filter_by(
+            user_id=user_id,
+            id=illness_id
+        ).first()
     if not illness:
         return {
             'status': 'failure',
@@ -70,15 +96,24 @@ def edit_illness(user_id, illness_id, new_title, start_date=None,
         }, 400
 
 
-def check_symptoms(data):
+def check_symptoms(data, user_id=None):
     response_object = {}
-    headers = {
-      'App-Id': os.getenv('API_APP_ID'),
-      'App-Key': os.getenv('API_APP_KEY'),
-      'Content-Type': 'application/json'
-    }
-    NLP_URL = "https://api.infermedica.com/v2/parse"
-    symptoms = requests.post(NLP_URL, headers=headers, json=data).json()
+    payload = dict(data)
+    payload['text'] = normalize_symptoms_text(data.get('text'))
+    key = json.dumps(payload, sort_keys=True)
+    symptoms = get_cached_parse(key)
+    if symptoms is None:
+        # only calls that reach Infermedica count against the user's limit
+        if user_id is not None and not get_parse_limiter(user_id).try_acquire():  # noqa: E501
+            return {
+                'status': 'failure',
+                'message': 'Too many symptom checks, please slow down.',
+                # lets the client keep its current symptoms instead of
+                # treating the missing mentions as an empty parse
+                'throttled': True,
+                'symptoms_json': {}
+            }, 429
+        symptoms = parse_symptoms_text(key, payload)
     response_object = {
         'status': 'success',
         'message': 'Successfully processed user symptom request',
@@ -119,10 +154,12 @@ def close_active_illness(user_id):
     if active_illness.active:
         response_object['message'] = 'Successfully deactivated active illness'
         active_illness.active = False
-        active_illness.updated_on = datetime.datetime.now()
+        # closing sets the illness end date, so never defer this touch
+        touch_illness(active_illness)
     else:
         response_object['message'] = 'No active illness found'
     db.session.add(active_illness)
+    flush_illness_touches()
     db.session.commit()
     return response_object, 200
 
@@ -152,11 +189,13 @@ def save_symptoms(data, user_id):
             created_on=datetime.datetime.utcnow()
         )
         db.session.add(active_illness)
-        db.session.commit()
+        # flush only to get the new illness id, everything commits together
+        db.session.flush()
     else:
         response_object['message'] = (
             'Added symptoms to active illness.'
         )
+        touch_illness(active_illness, deferred=True)
     for s in data['symptoms']:
         new_symptom = Symptom(
             user_id=user_id,
@@ -165,9 +204,8 @@ def save_symptoms(data, user_id):
             data=s
         )
         db.session.add(new_symptom)
-        db.session.commit()
-    active_illness.updated_on = datetime.datetime.now()
-    db.session.add(active_illness)
+    flush_illness_touches()
+    db.session.commit()
     perform_diagnosis(user, user_id, active_illness)
     return response_object, 200
 
@@ -178,7 +216,16 @@ def get_illness_history(user_id):
         user_id=user_id,
         active=False
     ).order_by(-Illness.id).limit(20)
-    illnesses = [i.get_json() for i in illnesses_query]
+    archived_query = IllnessArchive.query.filter_by(
+        user_id=user_id
+    ).order_by(-IllnessArchive.id).limit(20)
+    # merge live and archived illnesses, newest first
+    history = sorted(
+        list(illnesses_query) + list(archived_query),
+        key=lambda i: i.id,
+        reverse=True
+    )[:20]
+    illnesses = [i.get_json() for i in history]
     response_object = {
         'status': 'success',
         'message': 'Successfully retrieved user\'s illness history',
@@ -213,11 +260,11 @@ def edit_symptoms(symptom_id, new_date, user_id):
     symptom = Symptom.query.filter_by(id=symptom_id, user_id=user_id).first()
     if symptom:
         response_object['message'] = 'Edited Symptom'
-        active_illness.updated_on = datetime.datetime.now()
+        touch_illness(active_illness, deferred=True)
         symptom.updated_on = datetime.datetime.now()
         symptom.created_on = new_date
-        db.session.add(active_illness)
         db.session.add(symptom)
+        flush_illness_touches()
         db.session.commit()
     return response_object, 200
 
@@ -235,9 +282,9 @@ def delete_symptoms(symptom_id, user_id):
     symptom = Symptom.query.filter_by(id=symptom_id, user_id=user_id).first()
     if symptom:
         response_object['message'] = 'Deleted Symptom'
-        active_illness.updated_on = datetime.datetime.now()
-        db.session.add(active_illness)
+        touch_illness(active_illness, deferred=True)
         db.session.delete(symptom)
+        flush_illness_touches()
         db.session.commit()
         perform_diagnosis(user, user_id, active_illness)
     return response_object, 200
@@ -245,6 +292,13 @@ def delete_symptoms(symptom_id, user_id):
 
 def reopen_illness(user_id, illness_id):
     illness = Illness.query.filter_by(user_id=user_id, id=illness_id).first()
+    if not illness:
+        archived = IllnessArchive.query.filter_by(
+            user_id=user_id,
+            id=illness_id
+        ).first()
+        if archived:
+            illness = rehydrate_illness(archived)
     if not illness:
         return {
             'status': 'failure',
@@ -274,16 +328,132 @@ def reopen_illness(user_id, illness_id):
         }, 200
 
 
+# -------------------------------------------------- #
+#               SYMPTOMS PARSING LOGIC               #
+# -------------------------------------------------- #
+
+NLP_URL = "https://api.infermedica.com/v2/parse"
+# parse results are cached briefly since most requests are keystroke bursts
+PARSE_CACHE_TTL = float(os.getenv('PARSE_CACHE_TTL', '60'))
+PARSE_CACHE_SIZE = int(os.getenv('PARSE_CACHE_SIZE', '2048'))
+PARSE_CACHE = OrderedDict()
+PARSE_IN_FLIGHT = {}
+PARSE_LOCK = threading.Lock()
+# seconds a request waits on an identical in-flight call before calling
+# Infermedica itself
+PARSE_WAIT_TIMEOUT = float(os.getenv('PARSE_WAIT_TIMEOUT', '10'))
+# per-user limit on parse requests that miss the cache
+PARSE_RATE_PER_USER = float(os.getenv('PARSE_RATE_PER_USER', '3'))
+PARSE_BURST_PER_USER = int(os.getenv('PARSE_BURST_PER_USER', '10'))
+PARSE_LIMITERS = OrderedDict()
+PARSE_LIMITERS_SIZE = 10000
+
+
+def normalize_symptoms_text(text):
+    return ' '.join((text or '').lower().split())
+
+
+def get_cached_parse(key):
+    with PARSE_LOCK:
+        cached = PARSE_CACHE.get(key)
+        if cached is None:
+            return None
+        expires_at, symptoms = cached
+        if expires_at <= time.monotonic():
+            del PARSE_CACHE[key]
+            return None
+        PARSE_CACHE.move_to_end(key)
+        return symptoms
+
+
+def get_parse_limiter(user_id):
+    with PARSE_LOCK:
+        limiter = PARSE_LIMITERS.get(user_id)
+        if limiter is None:
+            limiter = TokenBucket(PARSE_RATE_PER_USER, PARSE_BURST_PER_USER)
+            PARSE_LIMITERS[user_id] = limiter
+            if len(PARSE_LIMITERS) > PARSE_LIMITERS_SIZE:
+                PARSE_LIMITERS.popitem(last=False)
+        else:
+            PARSE_LIMITERS.move_to_end(user_id)
+        return limiter
+
+
+def request_parse(payload):
+    headers = {
+      'App-Id': os.getenv('API_APP_ID'),
+      'App-Key': os.getenv('API_APP_KEY'),
+      'Content-Type': 'application/json'
+    }
+    return requests.post(NLP_URL, headers=headers, json=payload)
+
+
+# sends the parse request, identical requests already in flight wait for
+# and share the first one's result instead of calling Infermedica again
+def parse_symptoms_text(key, payload):
+    with PARSE_LOCK:
+        cached = PARSE_CACHE.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        call = PARSE_IN_FLIGHT.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = {'done': threading.Event(), 'result': None, 'error': None}
+            PARSE_IN_FLIGHT[key] = call
+    if not is_leader:
+        finished = call['done'].wait(PARSE_WAIT_TIMEOUT)
+        if finished and isinstance(call['error'], Exception):
+            raise call['error']
+        if finished and call['error'] is None:
+            return call['result']
+        # the first call is stuck or was interrupted, make our own
+        return request_parse(payload).json()
+    parse_resp = None
+    try:
+        try:
+            parse_resp = request_parse(payload)
+            call['result'] = parse_resp.json()
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with PARSE_LOCK:
+                PARSE_IN_FLIGHT.pop(key, None)
+                # error responses are not cached
+                if call['error'] is None and parse_resp.status_code == 200:
+                    PARSE_CACHE[key] = (
+                        time.monotonic() + PARSE_CACHE_TTL,
+                        call['result']
+                    )
+                    PARSE_CACHE.move_to_end(key)
+                    while len(PARSE_CACHE) > PARSE_CACHE_SIZE:
+                        PARSE_CACHE.popitem(last=False)
+    finally:
+        # always release the waiting requests, whatever happened above
+        call['done'].set()
+    return call['result']
+
+
 # -------------------------------------------------- #
 #               SYMPTOMS LOADING LOGIC               #
 # -------------------------------------------------- #
 
 # Determing JSON file path
 CURR_PATH = os.path.dirname(os.path.realpath(__file__))
-SYMPTOMS_FILE_PATH = os.path.join(
+DEFAULT_SYMPTOMS_FILE_PATH = os.path.join(
     CURR_PATH,
     'resources/illness_service/infermedica_symptoms_list.json'
 )
+SYMPTOMS_FILE_PATH = (
+    os.getenv('SYMPTOMS_FILE_PATH') or DEFAULT_SYMPTOMS_FILE_PATH
+)
+
+
+# precomputed symptoms list response, keyed by the catalog file version
+SYMPTOMS_RESPONSE_CACHE = {'version': None}
+SYMPTOMS_RESPONSE_LOCK = threading.Lock()
+SYMPTOMS_CACHE_CONTROL = 'public, max-age=86400'
+SYMPTOMS_FILE_MISSING = ('missing',)
 
 
 # function to update symptoms file
@@ -302,6 +472,8 @@ def download_symptoms_json():
     with open(SYMPTOMS_FILE_PATH, 'w+') as output_f:
         json.dump(symptoms, output_f)
     print('Successfully loaded symptoms list from Infermedica API')
+    # force the cached symptoms list response to be rebuilt
+    SYMPTOMS_RESPONSE_CACHE['version'] = None
 
 
 # Will run whenever the file is loaded (on application start)
@@ -334,14 +506,108 @@ def minify_symptoms():
 LEADED_SYMPTOMS, LOADED_SYMPTOMS_MIN = minify_symptoms()
 
 
-# Actual API service function
-def get_symptoms_list():
+# version of the symptoms file currently on disk
+def symptoms_file_version():
+    try:
+        stat = os.stat(SYMPTOMS_FILE_PATH)
+    except OSError:
+        # still a real version, so the empty response is cached as well
+        return SYMPTOMS_FILE_MISSING
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+# function to serialize and compress the symptoms list response once
+def build_symptoms_response(symptoms_min):
     response_object = {
         'status': 'success',
         'message': 'Successfully retrieved symptoms list',
-        'symptoms': LOADED_SYMPTOMS_MIN
+        'symptoms': symptoms_min
     }
-    return response_object, 200
+    body = json.dumps(response_object, separators=(',', ':')).encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    # each encoding is a different representation and needs its own ETag
+    variants = {
+        'identity': (body, '"{}"'.format(digest)),
+        'gzip': (
+            gzip.compress(body, compresslevel=9),
+            '"{}-gzip"'.format(digest)
+        )
+    }
+    if brotli is not None:
+        variants['br'] = (
+            brotli.compress(body, quality=11),
+            '"{}-br"'.format(digest)
+        )
+    return variants
+
+
+# returns the precomputed variants, rebuilding them if the file has changed
+def get_symptoms_response_variants():
+    global LEADED_SYMPTOMS, LOADED_SYMPTOMS_MIN
+    version = symptoms_file_version()
+    cache = SYMPTOMS_RESPONSE_CACHE
+    if cache['version'] is not None and cache['version'] == version:
+        return cache['variants']
+    with SYMPTOMS_RESPONSE_LOCK:
+        if cache['version'] is None or cache['version'] != version:
+            LEADED_SYMPTOMS, LOADED_SYMPTOMS_MIN = minify_symptoms()
+            cache['variants'] = build_symptoms_response(LOADED_SYMPTOMS_MIN)
+            cache['version'] = version
+        return cache['variants']
+
+
+# picks the best encoding the client accepts
+def choose_symptoms_encoding(accept_encoding, variants):
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            accepted[coding] = q
+    for coding in ('br', 'gzip'):
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if coding in variants and q > 0:
+            return coding
+    return 'identity'
+
+
+# Actual API service function
+def get_symptoms_list():
+    variants = get_symptoms_response_variants()
+    encoding = choose_symptoms_encoding(
+        request.headers.get('Accept-Encoding', ''),
+        variants
+    )
+    body, etag = variants[encoding]
+    headers = {
+        'ETag': etag,
+        'Cache-Control': SYMPTOMS_CACHE_CONTROL,
+        'Vary': 'Accept-Encoding'
+    }
+    if_none_match = request.headers.get('If-None-Match', '')
+    # If-None-Match uses weak comparison, so ignore any W/ prefix
+    client_etags = [
+        t.strip()[2:] if t.strip().startswith('W/') else t.strip()
+        for t in if_none_match.split(',')
+    ]
+    if etag in client_etags or '*' in client_etags:
+        return Response(status=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(
+        body,
+        status=200,
+        headers=headers,
+        mimetype='application/json'
+    )
 
 # -------------------------------------------------- #
 #           END OF SYMPTOMS LOADING LOGIC            #
@@ -352,26 +618,51 @@ def get_symptoms_list():
 #                DIAGNOSIS FUNCTION                  #
 # -------------------------------------------------- #
 def perform_diagnosis(user, user_id, active_illness):
+    evidence = []
+    for s in Symptom.query.filter_by(
+        user_id=user_id,
+        illness_id=active_illness.id
+    ).order_by(-Symptom.id).all():
+        evidence.append({
+            'id': s.data['id'],
+            'choice_id': 'present'
+        })
+    conditions = request_diagnosis_conditions(
+        user.sex.lower() if user.sex != "None" else 'male',
+        calculate_age(user.birthdate),
+        evidence
+    )
+    # save diagnosis to db
+    d = Diagnosis(
+        user_id=user_id,
+        illness_id=active_illness.id,
+        data=conditions
+    )
+    db.session.add(d)
+    db.session.commit()
+
+
+# queries Infermedica for the conditions matching the given evidence, does
+# not touch the database so it can be called from worker threads
+def request_diagnosis_conditions(sex, age, evidence, http=requests,
+                                 rate_limiter=None):
     headers = {
       'App-Id': os.getenv('API_APP_ID'),
       'App-Key': os.getenv('API_APP_KEY'),
       'Content-Type': 'application/json'
     }
+
+    def wait_for_rate_limit():
+        if rate_limiter is not None:
+            rate_limiter.acquire()
     diagnosis_url = "https://api.infermedica.com/v2/diagnosis"
     diagnosis_json = {
-        'evidence': [],
+        'sex': sex,
+        'age': age,
+        'evidence': evidence
     }
-    diagnosis_json['sex'] = user.sex.lower() if user.sex != "None" else 'male'
-    diagnosis_json['age'] = calculate_age(user.birthdate)
-    for s in Symptom.query.filter_by(
-        user_id=user_id,
-        illness_id=active_illness.id
-    ).order_by(-Symptom.id).all():
-        diagnosis_json['evidence'].append({
-            'id': s.data['id'],
-            'choice_id': 'present'
-        })
-    diagnosis = requests.post(
+    wait_for_rate_limit()
+    diagnosis = http.post(
         diagnosis_url,
         headers=headers,
         json=diagnosis_json
@@ -387,15 +678,13 @@ def perform_diagnosis(user, user_id, active_illness):
         )
     for idx, c in enumerate(conditions):
         c_json = {
-            'sex': user.sex.lower() if user.sex != "None" else 'male',
-            'age': calculate_age(user.birthdate),
+            'sex': sex,
+            'age': age,
             'target': c['id'],
-            'evidence': [{
-                'id': s.data['id'],
-                'choice_id': 'present'
-            } for s in active_illness.symptoms]
+            'evidence': evidence
         }
-        explanation = requests.post(
+        wait_for_rate_limit()
+        explanation = http.post(
             explanation_URL,
             headers=headers,
             json=c_json
@@ -403,7 +692,8 @@ def perform_diagnosis(user, user_id, active_illness):
         c['supporting_symptoms'] = explanation.get('supporting_evidence') or []
         c['opposing_symptoms'] = (explanation.get('conflicting_evidence') or []) + (explanation.get('unconfirmed_evidence') or [])  # noqa: E501
         # THE CONDITIONS ENDPOINT IS UNNECESSARY AND CAN BE CACHED LOCALLY
-        condition_info = requests.get(
+        wait_for_rate_limit()
+        condition_info = http.get(
             condition_URL(c['id']),
             headers=headers
         ).json()
@@ -413,11 +703,171 @@ def perform_diagnosis(user, user_id, active_illness):
         c['severity'] = condition_info.get('severity')
         # update active_diagnosis with data for condition
         conditions[idx] = c
-    # save diagnosis to db
-    d = Diagnosis(
-        user_id=user_id,
-        illness_id=active_illness.id,
-        data=conditions
+    return conditions
+
+
+# -------------------------------------------------- #
+#             ILLNESS TIMESTAMP BATCHING             #
+# -------------------------------------------------- #
+
+# seconds to coalesce deferred updated_on bumps across requests, 0 disables
+ILLNESS_TOUCH_WINDOW = float(os.getenv('ILLNESS_TOUCH_WINDOW', '0'))
+PENDING_ILLNESS_TOUCHES = {}
+PENDING_ILLNESS_TOUCHES_LOCK = threading.Lock()
+LAST_ILLNESS_TOUCH_FLUSH = {'at': time.monotonic()}
+# deferral is only used once start_illness_touch_flusher is running, so
+# buffered touches are always written even when traffic stops
+ILLNESS_TOUCH_FLUSHER = {'app': None}
+
+
+# marks an illness as updated. Immediate touches only set the attribute, so
+# they are written in the same UPDATE as any other change to the row when
+# the request commits. Deferred touches are buffered across requests and
+# written together by flush_illness_touches once the window has passed.
+def touch_illness(illness, deferred=False):
+    now = datetime.datetime.now()
+    if (not deferred or ILLNESS_TOUCH_WINDOW <= 0 or
+            ILLNESS_TOUCH_FLUSHER['app'] is None):
+        # a buffered older touch must not overwrite this one later
+        with PENDING_ILLNESS_TOUCHES_LOCK:
+            PENDING_ILLNESS_TOUCHES.pop(illness.id, None)
+        illness.updated_on = now
+        db.session.add(illness)
+        return
+    queue_illness_touches({illness.id: now})
+
+
+def queue_illness_touches(touches):
+    with PENDING_ILLNESS_TOUCHES_LOCK:
+        for illness_id, touched_on in touches.items():
+            queued = PENDING_ILLNESS_TOUCHES.get(illness_id)
+            if queued is None or queued < touched_on:
+                PENDING_ILLNESS_TOUCHES[illness_id] = touched_on
+
+
+# adds the buffered touches to the current transaction as a single UPDATE,
+# call right before committing
+def flush_illness_touches(force=False):
+    with PENDING_ILLNESS_TOUCHES_LOCK:
+        if not PENDING_ILLNESS_TOUCHES:
+            return
+        elapsed = time.monotonic() - LAST_ILLNESS_TOUCH_FLUSH['at']
+        if not force and elapsed < ILLNESS_TOUCH_WINDOW:
+            return
+        pending = dict(PENDING_ILLNESS_TOUCHES)
+        PENDING_ILLNESS_TOUCHES.clear()
+        LAST_ILLNESS_TOUCH_FLUSH['at'] = time.monotonic()
+    # kept until the transaction ends so a rollback can queue them again
+    db.session.info.setdefault('illness_touches', {}).update(pending)
+    # each illness gets its own touch time
+    touched_on = case(pending, value=Illness.id)
+    # only bump active illnesses, a closed illness' updated_on is its end
+    # date. updated_on is written with both local and UTC times elsewhere,
+    # so comparing against it can't tell which touch is newer.
+    Illness.query.filter(
+        Illness.id.in_(list(pending)),
+        Illness.active.is_(True)
+    ).update(
+        {Illness.updated_on: touched_on},
+        synchronize_session=False
     )
-    db.session.add(d)
-    db.session.commit()
+
+
+@event.listens_for(db.session, 'after_commit')
+def forget_flushed_illness_touches(session):
+    session.info.pop('illness_touches', None)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def requeue_flushed_illness_touches(session):
+    touches = session.info.pop('illness_touches', None)
+    if touches:
+        queue_illness_touches(touches)
+
+
+# writes the buffered touches in their own transaction
+def commit_illness_touches(app):
+    with app.app_context():
+        try:
+            flush_illness_touches(force=True)
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+        finally:
+            db.session.remove()
+
+
+# starts a daemon thread that writes deferred touches every window and on
+# exit, call once from create_app to enable ILLNESS_TOUCH_WINDOW
+def start_illness_touch_flusher(app):
+    if ILLNESS_TOUCH_WINDOW <= 0 or ILLNESS_TOUCH_FLUSHER['app'] is not None:
+        return
+    ILLNESS_TOUCH_FLUSHER['app'] = app
+
+    def run():
+        while True:
+            time.sleep(ILLNESS_TOUCH_WINDOW)
+            commit_illness_touches(app)
+    threading.Thread(target=run, daemon=True).start()
+    atexit.register(commit_illness_touches, app)
+
+
+# -------------------------------------------------- #
+#                  ILLNESS ARCHIVAL                  #
+# -------------------------------------------------- #
+
+# closed illnesses untouched for this many days are moved to the archive
+ILLNESS_ARCHIVE_AFTER_DAYS = int(os.getenv('ILLNESS_ARCHIVE_AFTER_DAYS', '90'))
+
+
+# moves inactive illnesses with their symptoms and diagnoses out of the live
+# tables in batches, meant to be run periodically as a manage.py command
+def archive_inactive_illnesses(days=ILLNESS_ARCHIVE_AFTER_DAYS,
+                               batch_size=500):
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+    archived = 0
+    archivable = (
+        Illness.active.is_(False),
+        Illness.updated_on < cutoff
+    )
+    while True:
+        # lock the batch so reopen_illness can't reactivate an illness
+        # between reading and deleting it, illnesses it holds are skipped
+        illnesses = Illness.query.options(
+            selectinload(Illness.symptoms),
+            selectinload(Illness.diagnoses)
+        ).filter(*archivable).order_by(Illness.id).limit(
+            batch_size
+        ).with_for_update(skip_locked=True, of=Illness).all()
+        if not illnesses:
+            break
+        illness_ids = [i.id for i in illnesses]
+        db.session.add_all([IllnessArchive.from_illness(i) for i in illnesses])
+        for model, column in ((Symptom, Symptom.illness_id),
+                              (Diagnosis, Diagnosis.illness_id)):
+            model.query.filter(column.in_(illness_ids)).delete(
+                synchronize_session=False
+            )
+        deleted = Illness.query.filter(
+            Illness.id.in_(illness_ids),
+            *archivable
+        ).delete(synchronize_session=False)
+        if deleted != len(illness_ids):
+            # an illness changed under us (no row locks, e.g. on SQLite),
+            # drop the batch and select it again
+            db.session.rollback()
+            continue
+        db.session.commit()
+        db.session.expunge_all()
+        archived += len(illness_ids)
+    print('Archived {} inactive illnesses'.format(archived))
+    return archived
+
+
+# moves an archived illness back into the live tables, the caller commits
+def rehydrate_illness(archived):
+    illness = archived.restore()
+    db.session.delete(archived)
+    db.session.add(illness)
+    return illness
@@ -0,0 +1,387 @@
+"""
+Offline performance regression suite for the illness and user services.
+
+Seeds an in-memory SQLite database with a synthetic population, replaces
+the Infermedica API with a local fake and checks every benchmarked service
+function against its query-count and latency budget.
+
+Usage: python -m app.main.service.service_benchmark [--users N] ...
+Exits with status 1 if a query budget is exceeded. Latency budgets are only
+reported unless --strict-latency is given, since they depend on the machine.
+"""
+# python library imports
+import argparse
+import contextlib
+import datetime
+import random
+import statistics
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+# Utility imports
+import requests
+from sqlalchemy import event
+
+# scenario name -> (max queries per call, max median latency in ms), the
+# latency budgets are for the default volumes below
+BUDGETS = {
+    'Illness.get_json': (3, 100),
+    'get_illness_history': (42, 1500),
+    'save_symptoms': (8, 100),
+    'edit_symptoms': (4, 40),
+    'edit_user_settings': (2, 25),
+    'get_symptoms_list': (0, 10)
+}
+CONDITIONS_PER_DIAGNOSIS = 3
+
+
+class FakeInfermedicaResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeInfermedica:
+    """ Answers the Infermedica endpoints the services call, offline """
+
+    def __init__(self, symptom_count):
+        self.symptoms = [{
+            'id': 's_{}'.format(i),
+            'name': 'Symptom {}'.format(i),
+            'common_name': 'Common symptom {}'.format(i),
+            'parent_id': None
+        } for i in range(symptom_count)]
+        self.calls = 0
+
+    def get(self, url, headers=None, **kwargs):
+        self.calls += 1
+        if url.endswith('/v2/symptoms'):
+            return FakeInfermedicaResponse(self.symptoms)
+        return FakeInfermedicaResponse({
+            'id': url.rsplit('/', 1)[-1],
+            'extras': {'hint': 'Consult a doctor.'},
+            'categories': ['Internal medicine'],
+            'prevalence': 'common',
+            'severity': 'mild'
+        })
+
+    def post(self, url, headers=None, json=None, **kwargs):
+        self.calls += 1
+        if url.endswith('/v2/parse'):
+            return FakeInfermedicaResponse({'mentions': self.symptoms[:2]})
+        if url.endswith('/v2/diagnosis'):
+            return FakeInfermedicaResponse({'conditions': [{
+                'id': 'c_{}'.format(i),
+                'name': 'Condition {}'.format(i),
+                'probability': 0.5 / (i + 1)
+            } for i in range(CONDITIONS_PER_DIAGNOSIS)]})
+        return FakeInfermedicaResponse({
+            'supporting_evidence': (json or {}).get('evidence', [])[:1],
+            'conflicting_evidence': [],
+            'unconfirmed_evidence': []
+        })
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context,
+                   executemany):
+        self.count += 1
+
+
+def seed_database(db, users, illnesses_per_user, symptoms_per_illness,
+                  symptom_types):
+    from app.main.model.illness import Illness, Symptom, Diagnosis
+    from app.main.model.user import User
+    rng = random.Random(0)
+    now = datetime.datetime.utcnow()
+    user_rows, illness_rows, symptom_rows, diagnosis_rows = [], [], [], []
+    illness_id = 0
+    symptom_id = 0
+    for user_id in range(1, users + 1):
+        user_rows.append({
+            'id': user_id,
+            'email': 'user{}@example.com'.format(user_id),
+            'registered_on': now,
+            'admin': False,
+            'birthdate': datetime.date(1960 + user_id % 40, 1, 1),
+            'first_name': 'User {}'.format(user_id),
+            'password_hash': 'x',
+            'sex': rng.choice(['Male', 'Female', 'None'])
+        })
+        for n in range(illnesses_per_user):
+            illness_id += 1
+            # the most recent illness of every user is the active one
+            is_active = n == illnesses_per_user - 1
+            started = now - datetime.timedelta(days=30 * (n + 1))
+            illness_rows.append({
+                'id': illness_id,
+                'user_id': user_id,
+                'title': 'Illness {}'.format(illness_id),
+                'active': is_active,
+                'created_on': started,
+                'updated_on': started + datetime.timedelta(days=7)
+            })
+            for _ in range(symptoms_per_illness):
+                symptom_id += 1
+                s = rng.randrange(symptom_types)
+                symptom_rows.append({
+                    'id': symptom_id,
+                    'user_id': user_id,
+                    'illness_id': illness_id,
+                    'title': 'Common symptom {}'.format(s),
+                    'data': {
+                        'id': 's_{}'.format(s),
+                        'common_name': 'Common symptom {}'.format(s),
+                        'choice_id': 'present',
+                        'type': 'symptom'
+                    },
+                    'created_on': started,
+                    'updated_on': started
+                })
+            diagnosis_rows.append({
+                'user_id': user_id,
+                'illness_id': illness_id,
+                'datetime': started,
+                'data': [{
+                    'id': 'c_{}'.format(i),
+                    'probability': 0.5 / (i + 1)
+                } for i in range(CONDITIONS_PER_DIAGNOSIS)]
+            })
+    for model, rows in ((User, user_rows), (Illness, illness_rows),
+                        (Symptom, symptom_rows), (Diagnosis, diagnosis_rows)):
+        db.session.execute(model.__table__.insert(), rows)
+    db.session.commit()
+
+
+def run_scenario(db, counter, func, rounds):
+    timings = []
+    max_queries = 0
+    for i in range(rounds):
+        # start from a cold session so identity map hits don't hide queries
+        db.session.remove()
+        counter.count = 0
+        start = time.perf_counter()
+        func(i)
+        timings.append((time.perf_counter() - start) * 1000)
+        max_queries = max(max_queries, counter.count)
+    return max_queries, statistics.median(timings), max(timings)
+
+
+def build_scenarios(app, db, users, symptom_types):
+    from app.main.model.illness import Illness, Symptom
+    from app.main.service import illness_service
+    from app.main.service.user_service import edit_user_settings
+    rng = random.Random(1)
+
+    def pick_user():
+        return rng.randint(1, users)
+
+    # symptoms of active illnesses, looked up once outside the timed calls
+    active_symptoms = db.session.query(Symptom.user_id, Symptom.id).join(
+        Illness,
+        Illness.id == Symptom.illness_id
+    ).filter(Illness.active.is_(True)).all()
+
+    def get_json(i):
+        Illness.query.filter_by(user_id=pick_user(), active=True).first(
+        ).get_json()
+
+    def get_illness_history(i):
+        illness_service.get_illness_history(pick_user())
+
+    def save_symptoms(i):
+        s = rng.randrange(symptom_types)
+        illness_service.save_symptoms({'symptoms': [{
+            'id': 's_{}'.format(s),
+            'common_name': 'Common symptom {}'.format(s),
+            'choice_id': 'present'
+        }]}, pick_user())
+
+    def edit_symptoms(i):
+        user_id, symptom_id = rng.choice(active_symptoms)
+        illness_service.edit_symptoms(
+            symptom_id,
+            datetime.datetime.utcnow(),
+            user_id
+        )
+
+    def edit_user_settings_(i):
+        edit_user_settings(
+            {'first_name': 'Renamed {}'.format(i), 'sex': 'Female'},
+            {'auth_object': {'data': {'user_id': pick_user()}}}
+        )
+
+    def get_symptoms_list(i):
+        with app.test_request_context(
+            headers={'Accept-Encoding': 'gzip, br'}
+        ):
+            illness_service.get_symptoms_list()
+
+    return {
+        'Illness.get_json': get_json,
+        'get_illness_history': get_illness_history,
+        'save_symptoms': save_symptoms,
+        'edit_symptoms': edit_symptoms,
+        'edit_user_settings': edit_user_settings_,
+        'get_symptoms_list': get_symptoms_list
+    }
+
+
+def is_in_memory(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (
+        None, '', ':memory:'
+    )
+
+
+@contextlib.contextmanager
+def offline_app(symptom_types=300):
+    """
+    Builds a Flask app on its own in-memory SQLite database with the
+    Infermedica API faked out, the app's configured database is never used
+    :return: (app, db)
+    """
+    infermedica = FakeInfermedica(symptom_types)
+    loaded_service = sys.modules.get('app.main.service.illness_service')
+    previous_catalog = getattr(loaded_service, 'SYMPTOMS_FILE_PATH', None)
+    # the illness service downloads the symptoms catalog when imported,
+    # keep the fake one out of the real resources directory
+    catalog_dir = tempfile.TemporaryDirectory()
+    catalog_path = os.path.join(catalog_dir.name, 'symptoms_list.json')
+    catalog_env = {'SYMPTOMS_FILE_PATH': catalog_path}
+    try:
+        with catalog_dir, mock.patch.dict(os.environ, catalog_env), \
+                mock.patch.object(requests, 'get', infermedica.get), \
+                mock.patch.object(requests, 'post', infermedica.post):
+            from flask import Flask
+            from app.main import db
+            # models have to be imported before create_all can see them
+            from app.main.model import illness, user  # noqa: F401
+            from app.main.service import illness_service
+            illness_service.SYMPTOMS_FILE_PATH = catalog_path
+            if loaded_service is not None:
+                illness_service.download_symptoms_json()
+            # create_app would bind db to the configured database before
+            # the URI could be overridden, so use a bare app instead
+            app = Flask(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+            db.init_app(app)
+            with app.app_context():
+                if not is_in_memory(db.engine.url):
+                    raise RuntimeError(
+                        'Refusing to benchmark on {}'.format(db.engine.url)
+                    )
+                db.create_all()
+                try:
+                    yield app, db
+                finally:
+                    db.session.remove()
+                    db.drop_all()
+    finally:
+        from app.main.service import illness_service
+        illness_service.SYMPTOMS_FILE_PATH = previous_catalog or (
+            os.getenv('SYMPTOMS_FILE_PATH') or
+            illness_service.DEFAULT_SYMPTOMS_FILE_PATH
+        )
+        illness_service.SYMPTOMS_RESPONSE_CACHE['version'] = None
+
+
+def run_benchmarks(users=2000, illnesses_per_user=20, symptoms_per_illness=5,
+                   symptom_types=300, rounds=50):
+    """
+    Seeds the database and measures every scenario
+    :return: dict of scenario name -> (max queries, median ms, max ms)
+    """
+    results = {}
+    with offline_app(symptom_types) as (app, db):
+        print('Seeding database...')
+        seed_database(
+            db,
+            users,
+            illnesses_per_user,
+            symptoms_per_illness,
+            symptom_types
+        )
+        counter = QueryCounter(db.engine)
+        scenarios = build_scenarios(app, db, users, symptom_types)
+        for name, func in scenarios.items():
+            results[name] = run_scenario(db, counter, func, rounds)
+    return results
+
+
+def check_budget(name, result, latency_scale=1.0):
+    """
+    Compares a scenario's result with its budgets
+    :return: dict with the query and latency violations, None if within
+    """
+    max_queries, median_ms, _ = result
+    query_budget, latency_budget = BUDGETS[name]
+    latency_budget *= latency_scale
+    problems = {'queries': None, 'latency': None}
+    if max_queries > query_budget:
+        problems['queries'] = '{} ran {} queries, budget is {}'.format(
+            name, max_queries, query_budget
+        )
+    if median_ms > latency_budget:
+        problems['latency'] = '{} took {:.2f} ms, budget is {:.2f} ms'.format(
+            name, median_ms, latency_budget
+        )
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0]
+    )
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--illnesses-per-user', type=int, default=20)
+    parser.add_argument('--symptoms-per-illness', type=int, default=5)
+    parser.add_argument('--symptom-types', type=int, default=300)
+    parser.add_argument('--rounds', type=int, default=50)
+    # slower CI boxes can scale the latency budgets up
+    parser.add_argument('--latency-scale', type=float, default=1.0)
+    parser.add_argument('--strict-latency', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.users,
+        args.illnesses_per_user,
+        args.symptoms_per_illness,
+        args.symptom_types,
+        args.rounds
+    )
+    failures = []
+    print('{:<22}{:>10}{:>12}{:>12}{:>10}'.format(
+        'scenario', 'queries', 'median ms', 'max ms', 'result'
+    ))
+    for name, result in results.items():
+        problems = check_budget(name, result, args.latency_scale)
+        status = 'ok'
+        if problems['latency']:
+            status = 'SLOW'
+            if args.strict_latency:
+                failures.append(problems['latency'])
+        if problems['queries']:
+            status = 'OVER'
+            failures.append(problems['queries'])
+        print('{:<22}{:>10}{:>12.2f}{:>12.2f}{:>10}'.format(
+            name, result[0], result[1], result[2], status
+        ))
+    if failures:
+        print('Budgets exceeded:\n{}'.format('\n'.join(failures)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
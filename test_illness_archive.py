@@ -0,0 +1,38 @@
+import datetime
+
+from app.main.service.service_benchmark import offline_app, seed_database
+
+
+def test_archived_ids_are_not_reused():
+    with offline_app(symptom_types=20) as (app, db):
+        from app.main.model.illness import Illness, IllnessArchive
+        from app.main.service import illness_service
+
+        def close_and_age(user_id):
+            illness_service.close_active_illness(user_id)
+            Illness.query.filter_by(user_id=user_id).update({
+                Illness.updated_on: datetime.datetime.now() -
+                datetime.timedelta(days=365)
+            })
+            db.session.commit()
+
+        # user 2 owns the highest illness ids
+        seed_database(db, 2, 4, 2, 20)
+        close_and_age(2)
+        archived_ids = {i.id for i in Illness.query.filter_by(user_id=2)}
+        assert illness_service.archive_inactive_illnesses(days=200) == 4
+
+        # the freed ids must not be handed to a new illness
+        illness_service.save_symptoms({'symptoms': [{
+            'id': 's_1',
+            'common_name': 'Common symptom 1',
+            'choice_id': 'present'
+        }]}, 2)
+        new_id = Illness.query.filter_by(user_id=2).one().id
+        assert new_id > max(archived_ids)
+
+        close_and_age(2)
+        assert illness_service.archive_inactive_illnesses(days=200) == 1
+        assert IllnessArchive.query.filter_by(user_id=2).count() == 5
+        for illness_id in archived_ids | {new_id}:
+            assert illness_service.get_illness(illness_id, 2)[1] == 200
@@ -0,0 +1,28 @@
+import pytest
+
+from app.main.service.service_benchmark import (
+    BUDGETS,
+    check_budget,
+    run_benchmarks
+)
+
+# latency budgets are set on a dev machine, shared CI runners get headroom
+LATENCY_SCALE = 5
+
+
+@pytest.fixture(scope='module')
+def results():
+    # smaller volumes keep the CI run short, query counts don't depend on it
+    return run_benchmarks(users=200, illnesses_per_user=20, rounds=10)
+
+
+@pytest.mark.parametrize('scenario', sorted(BUDGETS))
+def test_query_budget(results, scenario):
+    problems = check_budget(scenario, results[scenario], LATENCY_SCALE)
+    assert problems['queries'] is None, problems['queries']
+
+
+@pytest.mark.parametrize('scenario', sorted(BUDGETS))
+def test_latency_budget(results, scenario):
+    problems = check_budget(scenario, results[scenario], LATENCY_SCALE)
+    assert problems['latency'] is None, problems['latency']
@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """ Thread-safe token bucket for limiting request rates """
+
+    def __init__(self, rate, capacity=None):
+        # rate is tokens added per second, capacity is the burst size
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Takes tokens from the bucket without waiting
+        :return: boolean
+        """
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """ Blocks until tokens are available, then takes them """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)